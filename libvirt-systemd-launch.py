@@ -10,6 +10,7 @@ This script will be used to translate management actions from systemd to libvirt
 import argparse
 import libvirt
 import os
+import threading
 import time
 
 
@@ -18,6 +19,10 @@ ENV = {
     'delay': 'WAIT_CHECK_DELAY',
 }
 
+BACKOFF_INITIAL_SEC = 0.05
+BACKOFF_MAX_SEC = 2
+BACKOFF_FACTOR = 1.5
+
 
 def parse_args(*a, **ka):
     parser = argparse.ArgumentParser(
@@ -43,6 +48,7 @@ def parse_args(*a, **ka):
     parser.add_argument(
         '--timeout',
         default=os.getenv(ENV['timeout'], 120),
+        type=float,
         metavar='SECONDS',
         help=(
             f'timeout (in seconds) before action is considered failed. '
@@ -52,9 +58,10 @@ def parse_args(*a, **ka):
     parser.add_argument(
         '--delay',
         default=os.getenv(ENV['delay'], 1),
+        type=float,
         metavar='SECONDS',
         help=(
-            f'delay (in seconds) before repeating status checks. '
+            f'delay (in seconds) before repeating shutdown requests. '
             f'Default: ${ENV["delay"]} or 1'
         )
     )
@@ -62,9 +69,28 @@ def parse_args(*a, **ka):
     return args
 
 
+def libvirt_eventloop_start():
+    while True:
+        libvirt.virEventRunDefaultImpl()
+
+
 def main():
     args = parse_args()
-    connection = libvirt.open()
+    libvirt.virEventRegisterDefaultImpl()  # must be called before opening the connection
+    threading.Thread(
+        name='libvirt_event_loop',
+        target=libvirt_eventloop_start,
+        daemon=True,
+    ).start()
+    connection = libvirt.open()  # set $LIBVIRT_DEFAULT_URI to skip URI probing
+    try:
+        wait_for_action(connection, args)
+    finally:
+        connection.close()
+
+
+def wait_for_action(connection, args):
+    '''Execute management action and wait until domain reaches desired state'''
     domain = connection.lookupByName(args.domain)
     workers = {
         'start': domain.create,
@@ -78,17 +104,36 @@ def main():
         'start': False,
         'stop': True,
     }
+    events = {
+        'start': libvirt.VIR_DOMAIN_EVENT_STARTED,
+        'stop': libvirt.VIR_DOMAIN_EVENT_STOPPED,
+    }
+    state_changed = threading.Event()
+    def lifecycle(conn, dom, event, detail, opaque):
+        if event == events[args.action]:
+            state_changed.set()
+    connection.domainEventRegisterAny(
+        dom=domain,
+        eventID=libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+        cb=lifecycle,
+        opaque=None,
+    )
     def execute():
         if not success[args.action]():
             if workers[args.action]() != 0:
                 raise RuntimeError(f'failed to {args.action} domain: {args.domain}')
-    start = time.monotonic()
+    start = last_request = time.monotonic()
     execute()
-    while not success[args.action]():
-        if time.monotonic() > start + args.timeout:
+    delay = BACKOFF_INITIAL_SEC
+    while not success[args.action]():  # also covers events fired before callback registration
+        remaining = start + args.timeout - time.monotonic()
+        if remaining <= 0:
             raise RuntimeError(f'domain {args.action} took longer than {args.timeout} seconds: {args.domain}')
-        time.sleep(args.delay)
-        if repeat[args.action]:
+        state_changed.wait(timeout=min(delay, remaining))
+        state_changed.clear()
+        delay = min(delay * BACKOFF_FACTOR, BACKOFF_MAX_SEC)
+        if repeat[args.action] and time.monotonic() - last_request >= args.delay:
+            last_request = time.monotonic()  # guest may have been not ready to process ACPI events before
             execute()
 
 
@@ -8,52 +8,75 @@ source as in libvirt-guest-manager
 
 
 import argparse
+import ctypes
+import ctypes.util
 import os
+import re
+import signal
+import struct
 import subprocess
+import sys
 import threading
 import time
 from datetime import datetime
+from functools import partial
+from queue import Empty, SimpleQueue
 
 
 class LibvirtSystemdLogger:
 
     MIN_REPEAT_DELAY_SEC = 2
+    COALESCE_SEC = 0.05
+    WRITE_BATCH_MAX = 256
+    LIBVIRT_MARKERS = re.compile(rb': (starting up|shutting down)')
+    LIBVIRT_ACTIONS = {b'starting up': 'start', b'shutting down': 'stop'}
+    SYSTEMD_MARKERS = re.compile(rb'systemd\[1\]: (Starting|Stopped) Libvirt Guest Domain: (.*)')  # see Description= in libvirt-guest@.service
+    SYSTEMD_ACTIONS = {b'Starting': 'start', b'Stopped': 'stop'}
 
     def __init__(self, template_prefix: str, domains: list, control_fifo: str):
         self.template_prefix = template_prefix
         self.domains = domains
         self.control_fifo = control_fifo
-        self.lock = threading.RLock()
-        self.threads = []
-        self.threads.append(threading.Thread(
-            target=self.listen_fifo,
-            name='listen_fifo',
-            daemon=True,
-        ))
-        self.threads.append(threading.Thread(
-            target=self.systemd_start_stop,
-            name='systemd_start_stop',
-            daemon=True,
-        ))
-        self.threads.append(threading.Thread(
-            target=self.libvirt_reboot,
-            name='libvirt_reboot',
-            daemon=True,
-        ))
+        self.records = SimpleQueue()
+        self.stop = False
+        self.finished = threading.Event()
+        self.writer = self.thread(self.write_records, 'write_records')
+        self.threads = [
+            self.writer,
+            self.thread(self.listen_fifo, 'listen_fifo'),
+            self.thread(self.libvirt_reboot, 'libvirt_reboot'),
+        ]
+        self.libvirt_last = {}  # domain -> (action, time); owned by reactor thread
+        self.reactor = LogReactor()
+        self.reactor.add('/var/log/daemon.log', self.systemd_start_stop)
         for domain in self.domains:
-            self.threads.append(threading.Thread(
-                target=self.libvirt_start_stop,
-                args=(domain,),
-                name=f'libvirt_start_stop_{domain}',
-                daemon=True,
-            ))
+            self.reactor.add(
+                f'/var/log/libvirt/qemu/{domain}.log',
+                partial(self.libvirt_start_stop, domain),
+            )
+        self.threads.append(self.thread(self.reactor.run, 'log_reactor'))
+
+    def thread(self, target, name: str):
+        '''Create daemon thread that wakes up run() when target exits'''
+        def supervised():
+            try:
+                target()
+            finally:
+                self.finished.set()
+        return threading.Thread(target=supervised, name=name, daemon=True)
 
     def run(self):
+        signal.signal(signal.SIGTERM, self.terminate)
         self.start()
-        while not self.stop:
-            if not self.healthy():
-                raise RuntimeError(f'One of {self.__class__.__name__} subprocesses exited early')
-            time.sleep(1)
+        self.finished.wait()
+        if not self.stop:
+            raise RuntimeError(f'One of {self.__class__.__name__} subprocesses exited early')
+        self.records.put(None)
+        self.writer.join()
+
+    def terminate(self, signum, frame):
+        self.stop = True
+        self.finished.set()
 
     def start(self):
         self.stop = False
@@ -61,23 +84,42 @@ class LibvirtSystemdLogger:
             if not thread.is_alive():
                 thread.start()
 
-    def healthy(self):
-        for thread in self.threads:
-            if not thread.is_alive():
-                return False
-        return True
-
     def record(self, subsystem: str, action: str, domain: str):
-        with self.lock:
-            time_unix = self.timestamp()
-            time_utc = datetime.utcfromtimestamp(time_unix).strftime('%b %d %H:%M:%S')
-            print(yaml(dict(
-                time_unix=time_unix,
-                time_utc=time_utc,
-                subsystem=subsystem,
-                action=action,
-                domain=domain,
-            )))
+        self.records.put((self.timestamp(), subsystem, action, domain))
+
+    @staticmethod
+    def format_record(time_unix: float, subsystem: str, action: str, domain: str):
+        time_utc = datetime.utcfromtimestamp(time_unix).strftime('%b %d %H:%M:%S')
+        return yaml(dict(
+            time_unix=time_unix,
+            time_utc=time_utc,
+            subsystem=subsystem,
+            action=action,
+            domain=domain,
+        )).encode() + b'\n'
+
+    def write_records(self):
+        '''Write queued records to stdout in batches until None is received'''
+        output = sys.stdout.fileno()
+        finished = False
+        while not finished:
+            batch = [self.records.get()]
+            while len(batch) < self.WRITE_BATCH_MAX:
+                try:
+                    batch.append(self.records.get_nowait())
+                except Empty:
+                    break
+            if None in batch:
+                batch = batch[:batch.index(None)]
+                finished = True
+            chunks = [self.format_record(*record) for record in batch]
+            written = os.writev(output, chunks)
+            if written < sum(len(chunk) for chunk in chunks):  # short writes are rare but legal
+                remaining = b''.join(chunks)[written:]
+            else:
+                remaining = b''
+            while remaining:
+                remaining = remaining[os.write(output, remaining):]
 
     def timestamp(self):
         return time.time()
@@ -94,17 +136,18 @@ class LibvirtSystemdLogger:
                     break
         os.unlink(self.control_fifo)
 
-    def libvirt_start_stop(self, domain):
-        '''Listen to libvirt domain start/stop events (no reboot events here)'''
-        markers = {
-            'start': ': starting up',
-            'stop': ': shutting down',
-        }
-        for line in tail(f'/var/log/libvirt/qemu/{domain}.log'):
-            for action, marker in markers.items():
-                if marker in line.lower():
-                    self.record('libvirt', action, domain)
-                    continue
+    def libvirt_start_stop(self, domain, line):
+        '''Handle libvirt domain log line: start/stop events (no reboot events here)'''
+        match = self.LIBVIRT_MARKERS.search(line)
+        if not match:
+            return
+        action = self.LIBVIRT_ACTIONS[match.group(1)]
+        now = time.monotonic()
+        prev_action, prev_time = self.libvirt_last.get(domain, (None, None))
+        self.libvirt_last[domain] = (action, now)
+        if action == prev_action and now - prev_time < self.COALESCE_SEC:
+            return
+        self.record('libvirt', action, domain)
 
     def libvirt_reboot(self):
         '''
@@ -117,40 +160,151 @@ class LibvirtSystemdLogger:
             https://unix.stackexchange.com/questions/25372
         '''
         command = 'stdbuf -o0 virsh event --event reboot --loop'.split()
-        prev_event = 0
+        prev_event = float('-inf')
         for line in stdout(command):
-            if self.timestamp() - prev_event <= self.MIN_REPEAT_DELAY_SEC:
+            now = time.monotonic()
+            if now - prev_event <= self.MIN_REPEAT_DELAY_SEC:
                 continue
-            prev_event = self.timestamp()
-            domain = line.split("'")[3]
+            prev_event = now
+            domain = line.split(b"'")[3].decode(errors='replace')
             self.record('libvirt', 'restart', domain)
 
-    def systemd_start_stop(self):
-        '''Listen to systemd unit start/stop events (no restarts here)'''
-        markers = {
-            'start': 'systemd[1]: Starting Libvirt Guest Domain: ',
-            'stop': 'systemd[1]: Stopped Libvirt Guest Domain: ',
-        }
-        for line in tail('/var/log/daemon.log'):
-            for action, marker in markers.items():
-                if marker.lower() in line.lower():
-                    marker_start = line.lower().find(marker.lower())
-                    domain = line[marker_start+len(marker):].strip().rstrip('.')
-                    self.record('systemd', action, domain)
+    def systemd_start_stop(self, line):
+        '''Handle system log line: systemd unit start/stop events (no restarts here)'''
+        match = self.SYSTEMD_MARKERS.search(line)
+        if match:
+            domain = match.group(2).decode(errors='replace').strip().rstrip('.')
+            self.record('systemd', self.SYSTEMD_ACTIONS[match.group(1)], domain)
+
+
+class Inotify:
+    '''Minimal ctypes wrapper for Linux inotify API'''
+
+    IN_MODIFY = 0x00000002
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+    BUFFER_SIZE = 4096
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
 
+    def add_watch(self, path: str, mask: int):
+        watch = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if watch < 0:
+            self._raise()
+        return watch
 
-def tail(filepath: str):
-    '''Yield new lines from text file as they are appended to it'''
-    command = 'tail -n0 -F'.split()
-    command.append(filepath)
-    yield from stdout(command)
+    def events(self):
+        '''Yield lists of (watch, mask, name) tuples: one list per wakeup'''
+        buffer = bytearray(self.BUFFER_SIZE)  # reused for every read
+        view = memoryview(buffer)
+        while True:
+            size = os.readv(self.fd, [buffer])
+            batch = []
+            offset = 0
+            while offset < size:
+                watch, mask, _, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+                offset += self.EVENT_HEADER.size
+                name = bytes(view[offset:offset+length]).rstrip(b'\0')
+                offset += length
+                batch.append((watch, mask, os.fsdecode(name)))
+            yield batch
+
+
+class LogFile:
+    '''Log file being followed: yields only the lines appended after opening'''
+
+    READ_SIZE = 65536
+
+    def __init__(self, filepath: str, callback):
+        self.filepath = filepath
+        self.callback = callback
+        self.partial = bytearray()
+        try:
+            self.fd = os.open(filepath, os.O_RDONLY | os.O_CLOEXEC)
+            os.lseek(self.fd, 0, os.SEEK_END)
+        except FileNotFoundError:
+            self.fd = None
+
+    def reopen(self):
+        '''File was created or replaced (log rotation)'''
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.filepath, os.O_RDONLY | os.O_CLOEXEC)
+        self.partial.clear()
+
+    def read(self):
+        '''Pass newly appended complete lines (as bytes) to callback'''
+        if self.fd is None:
+            return
+        if os.fstat(self.fd).st_size < os.lseek(self.fd, 0, os.SEEK_CUR):  # truncated
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            self.partial.clear()
+        while True:
+            chunk = os.read(self.fd, self.READ_SIZE)
+            if not chunk:
+                break
+            self.partial += chunk
+        start = 0
+        while True:
+            end = self.partial.find(b'\n', start)
+            if end == -1:
+                break
+            self.callback(bytes(self.partial[start:end]))
+            start = end + 1
+        del self.partial[:start]
+
+
+class LogReactor:
+    '''
+    Follow multiple log files from a single thread
+
+    Parent directories are watched via one shared inotify instance, so files
+    may be created or replaced (log rotation) at any time, just like with
+    `tail -F`
+    '''
+
+    WATCH_MASK = Inotify.IN_MODIFY | Inotify.IN_CREATE | Inotify.IN_MOVED_TO
+
+    def __init__(self):
+        self.inotify = Inotify()
+        self.directories = {}  # watch descriptor -> directory
+        self.files = {}  # (directory, filename) -> LogFile
+
+    def add(self, filepath: str, callback):
+        '''Call callback(line) for every line appended to filepath'''
+        directory, filename = os.path.split(os.path.abspath(filepath))
+        watch = self.inotify.add_watch(directory, self.WATCH_MASK)  # same wd for repeated calls
+        self.directories[watch] = directory
+        self.files[directory, filename] = LogFile(filepath, callback)
+
+    def run(self):
+        for batch in self.inotify.events():
+            modified = {}  # a burst of writes results in one read per file
+            for watch, mask, name in batch:
+                logfile = self.files.get((self.directories.get(watch), name))
+                if logfile is None:
+                    continue
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    logfile.read()  # leftovers from replaced file
+                    logfile.reopen()
+                modified[id(logfile)] = logfile
+            for logfile in modified.values():
+                logfile.read()
 
 
 def stdout(command: list):
-    '''Yield stdout lines from subprocess as they arrive'''
+    '''Yield stdout lines (as bytes) from subprocess as they arrive'''
     process = subprocess.Popen(command, stdout=subprocess.PIPE)
-    for line in process.stdout:
-        yield line.decode()
+    yield from process.stdout
 
 
 def yaml(dictionary):